@@ -844,9 +844,14 @@ class Transaction(db.Model):
     txn_date = db.Column(db.String(20))  # Date string YYYY-MM-DD
     txn_time = db.Column(db.String(20))  # Time string HH:MM:SS
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    
+
     # Relationship
     user = db.relationship('User', backref=db.backref('transactions', lazy='dynamic'))
+
+    # Ensure the same transaction can't be recorded twice for a user
+    __table_args__ = (
+        db.UniqueConstraint('transaction_id', 'user_id', name='unique_txn_user'),
+    )
     
     def to_dict(self):
         """Convert transaction to dictionary for backward compatibility"""